@@ -1,8 +1,9 @@
 import argparse
-import time
+import asyncio
+import random
 from pprint import pprint
 
-import requests
+import httpx
 
 # Define and parse command line arguments.
 parser = argparse.ArgumentParser(
@@ -17,11 +18,14 @@ parser.add_argument(
     "-b", "--base-url",
     help="The base URL (e.g. http://localhost:8008) to use to interact with the homeserver"
 )
+# The admin API can't filter on member counts server-side, so we inevitably download
+# some rooms only to skip them. Requesting large batches at least amortises the
+# per-request overhead over more useful work.
 parser.add_argument(
     "-s", "--batch-size",
     help="The amount of rooms in a batch",
     type=int,
-    default=100,
+    default=500,
 )
 
 args = parser.parse_args()
@@ -29,98 +33,209 @@ args = parser.parse_args()
 # Constants reused throughout the script.
 ADMIN_BASE_URL = f"{args.base_url}/_synapse/admin"
 BATCH_SIZE = args.batch_size
-
-# Use a requests.Session to set the Authorization header so we don't have to do it again
-# for each request.
-s = requests.Session()
-s.headers["Authorization"] = f"Bearer {args.access_token}"
-
-# Keep iterating as long as the number of deleted rooms does not match the batch size.
-# When we request the list of rooms, we request that they're ordered in increasing number
-# of joined local members. Therefore, we know that if we start ignoring rooms because
-# they've got at least one joined local member, then we've processed all the rooms we want
-# to process.
-deleted_rooms = BATCH_SIZE
-while deleted_rooms == BATCH_SIZE:
-    # Get the next batch of rooms to process.
-    res = s.get(
-        f"{ADMIN_BASE_URL}/v1/rooms?limit={BATCH_SIZE}&order_by=joined_local_members&dir=b"
+# The maximum number of rooms we'll be deleting at any given time. We're dealing with a
+# large amount of rooms, with a number of those likely to hold a lot of historical data
+# which can be costly to delete, so we don't want to overload the homeserver by kicking
+# off a deletion for every single room at once.
+MAX_CONCURRENT_DELETIONS = 8
+
+
+async def process_room(session: httpx.AsyncClient, room_id: str) -> None:
+    """Request the deletion of the given room and watch the deletion status until it
+    completes (successfully or not).
+    """
+    print(f"Deleting room {room_id}")
+
+    # Send a deletion request for the room. httpx doesn't allow a body on its delete
+    # shorthand, so spell the method out.
+    res = await session.request(
+        "DELETE", f"{ADMIN_BASE_URL}/v2/rooms/{room_id}", json={}
     )
-    if not res.ok:
-        # If the request failed, we want to consider this as fatal, because there's no use
-        # hammering the same endpoint and there isn't much we can do besides that.
-        print("Failed to retrieve more rooms, details:")
+    if not res.is_success:
+        # If the deletion request failed, just give up on this room. We don't want to
+        # fail the entire script in this case, because the error may not be fatal.
+        # For example, this might fail if there's already a purge process happening
+        # for this room, which might be the case if a previous run of this script has
+        # been interrupted and the script has then been run very shortly after this
+        # interruption.
+        print(f"Failed to request deletion for room {room_id}, skipping. Details:")
         pprint(res.json())
-        exit(1)
-
-    rooms = res.json()["rooms"]
-
-    print(f"Retrieved {len(rooms)} more rooms")
-    deleted_rooms = 0
-
-    # Delete each room in turn, synchronously.
-    for room in rooms:
-        room_id = room['room_id']
-
-        # Skip rooms that have local members joined to them.
-        if room["joined_local_members"] != 0:
-            print(f"Room {room_id} has local users, skipping")
-            continue
-
-        print(f"Deleting room {room_id}")
-
-        # Increment the counter here, so we don't have to do it twice (since we also need
-        # to do it if we fail the DELETE request).
-        deleted_rooms += 1
-
-        # Send a deletion request for the room.
-        res = s.delete(f"{ADMIN_BASE_URL}/v2/rooms/{room_id}", json={})
-        if not res.ok:
-            # If the deletion request failed, just skip the iteration. We don't want to
-            # fail the entire script in this case, because the error may not be fatal. For
-            # example, this might fail if there's already a purge process happening for
-            # this room, which might be the case if a previous run of this script has
-            # been interrupted and the script has then been run very shortly after this
-            # interruption.
-            print(f"Failed to request deletion for room {room_id}, skipping. Details:")
-            pprint(res.json())
-            continue
-
-        # Retrieve the deletion ID for the room.
-        del_id = res.json()["delete_id"]
-
-        status = "purging"
-        last_res_json = {}
-        # Watch the deletion status for the room.
-        # While the endpoint itself is asynchronous, we're currently using it
-        # synchronously. This is because we're dealing with a large amount of rooms, with
-        # a number of those likely to hold a lot of historical data which can be costly
-        # to delete, so we don't want to overload the homeserver by sending a request for
-        # every single room.
-        # We could start deleting several rooms at once and limit the number of concurrent
-        # deletions, but that's more than I am willing to implement in a quick one time
-        # use script at 1AM on a Sunday morning.
-        while status == "purging":
-            # Sleep between requests so we don't flood the server with those. It would
-            # probably be fine if we didn't do that, however it makes Synapse logs fairly
-            # annoying to read.
-            time.sleep(1)
-            res = s.get(f"{ADMIN_BASE_URL}/v2/rooms/delete_status/{del_id}")
-            # In case of a failure, simply retry.
-            if not res.ok:
+        return
+
+    # Retrieve the deletion ID for the room.
+    del_id = res.json()["delete_id"]
+
+    status = "purging"
+    last_res_json = {}
+    # Parameters for the exponential backoff we apply when a status request fails:
+    # rather than immediately re-entering the loop at full speed, wait increasingly
+    # long between attempts (with some jitter so concurrent deletions don't all retry
+    # in lockstep), capped so we don't end up waiting forever between polls.
+    backoff_base = 0.5
+    backoff_cap = 30.0
+    max_failed_attempts = 6
+    failed_attempts = 0
+    # Start by polling the status every second, but stretch the interval a bit after
+    # each poll (capped at 15s): short purges still complete quickly, while large
+    # room purges that take minutes don't get hammered with a request every second.
+    poll_interval = 1.0
+    # Watch the deletion status for the room.
+    while status == "purging":
+        # Sleep between requests so we don't flood the server with those. It would
+        # probably be fine if we didn't do that, however it makes Synapse logs fairly
+        # annoying to read. Since this is an asyncio sleep, other rooms' deletions
+        # keep making progress while we wait.
+        await asyncio.sleep(poll_interval)
+        poll_interval = min(poll_interval * 1.5, 15.0)
+        res = await session.get(f"{ADMIN_BASE_URL}/v2/rooms/delete_status/{del_id}")
+        # Parse the body once, whether we're on the happy path or not.
+        body = res.json()
+
+        # In case of a failure, retry with backoff. Don't log each failed attempt:
+        # pprint is surprisingly expensive (it recursively walks the payload and
+        # computes widths), and with thousands of rooms and a flaky server it can
+        # fire a lot. Only dump the response once we actually give up on the room.
+        if not res.is_success:
+            if failed_attempts + 1 == max_failed_attempts:
                 print(
-                    f"Failed to retrieve deletion status for room {room_id} (delete_id:"
-                    f" {del_id}), details:"
+                    f"Giving up on retrieving deletion status for room {room_id}"
+                    f" (delete_id: {del_id}) after {max_failed_attempts} attempts,"
+                    " details:"
                 )
-                pprint(res.json())
-
-            last_res_json = res.json()
-            status = last_res_json["status"]
-
-        # If a room has failed deletion (on the Synapse side), log the full JSON payload
-        # so we have access to actually helpful data.
-        if status == "failed":
-            print(f"Failed to delete room {room_id}, details:")
-            pprint(last_res_json)
+                pprint(body)
+                return
+
+            delay = min(
+                backoff_cap, backoff_base * 2 ** failed_attempts
+            ) + random.uniform(0, backoff_base)
+            # If the server is rate-limiting us and tells us how long to wait, trust
+            # it over our own schedule.
+            retry_after = res.headers.get("Retry-After")
+            if res.status_code == 429 and retry_after is not None and retry_after.isdigit():
+                delay = float(retry_after)
+
+            failed_attempts += 1
+            await asyncio.sleep(delay)
+            continue
 
-    print(f"Deleted {deleted_rooms}/{len(rooms)} rooms")
+        failed_attempts = 0
+        last_res_json = body
+        status = last_res_json["status"]
+
+    # If a room has failed deletion (on the Synapse side), log the full JSON payload
+    # so we have access to actually helpful data.
+    if status == "failed":
+        print(f"Failed to delete room {room_id}, details:")
+        pprint(last_res_json)
+
+
+async def produce_rooms(session: httpx.AsyncClient, queue: "asyncio.Queue[str]") -> None:
+    """Page through the room list and feed the eligible room IDs to the deletion workers.
+
+    Listing rooms and deleting them happen in parallel this way: while the workers are
+    busy purging one page's worth of rooms, the next page is already being fetched
+    instead of the script idling on the list request.
+    """
+    # Page through the room list using the server's pagination cursor: each response
+    # includes a next_batch token pointing at the following page, and the last page
+    # omits it. Without the cursor, every iteration re-requested the top of the list,
+    # which kept returning the rooms we'd already skipped (and could loop forever if
+    # a page contained nothing but skipped rooms).
+    from_token = None
+    while True:
+        # Get the next batch of rooms to process.
+        url = (
+            f"{ADMIN_BASE_URL}/v1/rooms"
+            f"?limit={BATCH_SIZE}&order_by=joined_local_members&dir=b"
+        )
+        if from_token is not None:
+            url += f"&from={from_token}"
+
+        res = await session.get(url)
+        if not res.is_success:
+            # If the request failed, we want to consider this as fatal, because
+            # there's no use hammering the same endpoint and there isn't much we can
+            # do besides that.
+            print("Failed to retrieve more rooms, details:")
+            pprint(res.json())
+            exit(1)
+
+        body = res.json()
+        rooms = body["rooms"]
+
+        print(f"Retrieved {len(rooms)} more rooms")
+
+        # Filter out rooms that have local members joined to them. Report the skips
+        # as a single line rather than one per room, which gets noisy with large
+        # batches.
+        eligible_rooms = [
+            room for room in rooms if room["joined_local_members"] == 0
+        ]
+        if len(eligible_rooms) != len(rooms):
+            print(
+                f"Skipping {len(rooms) - len(eligible_rooms)} rooms that have local"
+                " users"
+            )
+
+        # Hand the rooms over to the workers. The queue's maxsize bounds how far
+        # ahead of the deletions the listing can run, so we don't buffer the entire
+        # room directory in memory.
+        for room in eligible_rooms:
+            await queue.put(room["room_id"])
+
+        # Follow the cursor to the next page, and stop once there isn't one.
+        from_token = body.get("next_batch")
+        if from_token is None:
+            break
+
+
+async def delete_worker(session: httpx.AsyncClient, queue: "asyncio.Queue[str]") -> None:
+    """Pop room IDs off the queue and delete them, until cancelled."""
+    while True:
+        room_id = await queue.get()
+        try:
+            await process_room(session, room_id)
+        except Exception as e:
+            # Don't let an unexpected error (say, a reverse proxy answering a status
+            # poll with an HTML 502 that fails to parse as JSON) kill the worker: that
+            # would silently lose a concurrency slot, and with every worker dead the
+            # script would hang on the queue instead of making progress. Log and move
+            # on to the next room, the same way we skip rooms that fail deletion.
+            print(f"Failed to process room {room_id}, skipping. Details:")
+            print(f"{type(e).__name__}: {e}")
+        finally:
+            queue.task_done()
+
+
+async def main() -> None:
+    # Use a single HTTP/2 client for the whole run, both to set the Authorization header
+    # in one place and so that every request - including all the concurrent deletions and
+    # status polls - is multiplexed over one TCP+TLS connection instead of paying
+    # per-request handshakes or head-of-line blocking across separate sockets.
+    async with httpx.AsyncClient(
+        http2=True,
+        headers={"Authorization": f"Bearer {args.access_token}"},
+        limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+    ) as session:
+        # Producer/consumer setup: one task pages through the room list, a fixed pool of
+        # workers deletes the rooms it queues up. The number of workers bounds how many
+        # deletions are in flight at once, which is what the semaphore used to do.
+        queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=200)
+        workers = [
+            asyncio.create_task(delete_worker(session, queue))
+            for _ in range(MAX_CONCURRENT_DELETIONS)
+        ]
+
+        # List every room, then wait for the workers to drain the queue before tearing
+        # them down.
+        await produce_rooms(session, queue)
+        await queue.join()
+
+        for worker in workers:
+            worker.cancel()
+        # Wait for the cancellations to actually land before the client gets closed
+        # underneath the workers.
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+asyncio.run(main())
@@ -1,9 +1,10 @@
 import argparse
 import asyncio
+import random
 import urllib.parse
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
-import aiohttp
+import httpx
 from attrs import define
 from tqdm import tqdm
 
@@ -14,6 +15,8 @@ class HttpError(Exception):
     code: int
     content: str
     url: str
+    # The value of the Retry-After header, if the response included one.
+    retry_after: Optional[str] = None
 
 
 class Client:
@@ -23,25 +26,58 @@ class Client:
 
         self.base_url = None
         self.joined_rooms = []
+        self.joined_rooms_set = set()
+        self.dm_rooms = None
         self.rooms_in_space = {}
+        self._session = None
 
     async def init(self) -> None:
         """Some async operations that can't be done in synchronous __init__, such as well-known resolution or populating
         the list of joined rooms.
         """
+        # Create a single session to use for every request, rather than one per request:
+        # this way requests reuse the session's connection instead of paying a full
+        # TCP+TLS handshake every time, which adds up quickly when iterating over
+        # thousands of joined rooms. With HTTP/2, a single connection is all we need:
+        # every concurrent request gets multiplexed over it, sharing one TLS session and
+        # one congestion window instead of competing across sockets.
+        self._session = httpx.AsyncClient(
+            http2=True,
+            headers={"Authorization": f"Bearer {self.tok}"},
+            limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        )
+
         split = self.user_id.split(":")
         if len(split) != 2:
             raise RuntimeError("Invalid user ID, please use the full identifier in the format: @user:domain.com")
 
         domain = split[1]
         try:
-            resp = await self._req("GET", f"https://{domain}/.well-known/matrix/client")
+            resp = await self._req_with_retry("GET", f"https://{domain}/.well-known/matrix/client")
             self.base_url = resp["m.homeserver"]["base_url"]
         except HttpError:
             self.base_url = f"https://{domain}"
 
-        resp = await self._req("GET", "/_matrix/client/v3/joined_rooms")
+        resp = await self._req_with_retry("GET", "/_matrix/client/v3/joined_rooms")
         self.joined_rooms = resp["joined_rooms"]
+        # Also keep a set version around: for an account in thousands of rooms, checking
+        # membership against the list makes every lookup a linear scan.
+        self.joined_rooms_set = set(self.joined_rooms)
+
+        # Fetch the list of rooms the account has flagged as DMs. Only those rooms can
+        # possibly be DMs with space members, so knowing them upfront means we don't have
+        # to pull the member list of every single joined room later on. Not every account
+        # has this account data though, in which case we leave dm_rooms as None and fall
+        # back to inspecting everything.
+        try:
+            resp = await self._req_with_retry(
+                "GET", f"/_matrix/client/v3/user/{self.user_id}/account_data/m.direct"
+            )
+            self.dm_rooms = {
+                room_id for room_ids in resp.values() for room_id in room_ids
+            }
+        except HttpError:
+            self.dm_rooms = None
 
     async def find_rooms_in_space(self, space: str) -> None:
         """Populate the joined rooms that are related to the given space. These are the rooms shown by /hierarchy, as
@@ -55,15 +91,15 @@ class Client:
         space_id = space
         if space.startswith("#"):
             print("Resolving space...")
-            resp = await self._req("GET", f"/_matrix/client/v3/directory/room/{urllib.parse.quote(space)}")
+            resp = await self._req_with_retry("GET", f"/_matrix/client/v3/directory/room/{urllib.parse.quote(space)}")
             space_id = resp["room_id"]
 
         print("Retrieving space hierarchy...")
-        resp = await self._req("GET", f"/_matrix/client/v1/rooms/{space_id}/hierarchy")
+        resp = await self._req_with_retry("GET", f"/_matrix/client/v1/rooms/{space_id}/hierarchy")
         self.rooms_in_space = {
             room["room_id"]: room["name"]
             for room in resp["rooms"]
-            if room["room_id"] in self.joined_rooms
+            if room["room_id"] in self.joined_rooms_set
         }
 
         await self._dm_rooms_in_space(space_id)
@@ -74,18 +110,19 @@ class Client:
         Args:
             space_id: The room ID of the space.
         """
-        def _is_dm_in_space(joined_users: Dict[str, Dict]) -> bool:
+        def _is_dm_in_space(joined_users: Dict[str, Dict], members_set: set) -> bool:
             """Returns true if the room is a DM with a user in the space, i.e. it only has 2 joined users which are us
             and a member of the space.
 
             Args:
                 joined_users: The joined users in the room, in the format returned by /joined_members.
+                members_set: The user IDs of the members of the space.
             """
             if len(joined_users) != 2:
                 return False
 
             for user in joined_users.keys():
-                if not user == self.user_id and user not in members.keys():
+                if not user == self.user_id and user not in members_set:
                     return False
 
             return True
@@ -104,23 +141,53 @@ class Client:
 
         print("Identifying related DMs...")
 
-        resp = await self._req("GET", f"/_matrix/client/v3/rooms/{space_id}/joined_members")
-        members = {
-            key: value.get("display_name", key)
-            for key, value in resp["joined"].items()
-        }
+        resp = await self._req_with_retry("GET", f"/_matrix/client/v3/rooms/{space_id}/joined_members")
+        # Materialise the set of members once, so each room's check is a set lookup
+        # instead of walking a dict key view every time.
+        members_set = set(resp["joined"].keys())
+
+        # Limit the number of concurrent lookups, so we don't hammer the homeserver with
+        # one request per joined room all at once.
+        sem = asyncio.Semaphore(16)
+
+        async def _joined_members(room_id: str):
+            """Fetch the joined members of the given room.
+
+            Args:
+                room_id: The ID of the room to inspect.
+            """
+            async with sem:
+                resp = await self._req_with_retry("GET", f"/_matrix/client/v3/rooms/{room_id}/joined_members")
+            return room_id, resp["joined"]
+
+        # If we know which rooms the account flagged as DMs, restrict the fan-out to
+        # those - for most accounts that's dozens of rooms instead of thousands. The
+        # m.direct data can reference rooms we've since left, hence the intersection with
+        # the joined rooms.
+        if self.dm_rooms is not None:
+            candidate_rooms = [
+                room_id for room_id in self.joined_rooms if room_id in self.dm_rooms
+            ]
+        else:
+            candidate_rooms = self.joined_rooms
 
-        # Use a progress bar to indicate progress in inspecting each room.
+        rooms_to_inspect = [
+            room_id for room_id in candidate_rooms
+            if room_id not in self.rooms_in_space.keys()
+        ]
+
+        # Use a progress bar to indicate progress in inspecting each room. Fan the
+        # lookups out concurrently (bounded by the semaphore) and process each one as it
+        # completes, so the bar updates as we go rather than all at the end.
         with tqdm(total=len(self.joined_rooms), unit=" rooms") as pbar:
-            for room_id in self.joined_rooms:
-                if room_id in self.rooms_in_space.keys():
-                    pbar.update(1)
-                    continue
+            pbar.update(len(self.joined_rooms) - len(rooms_to_inspect))
 
-                resp = await self._req("GET", f"/_matrix/client/v3/rooms/{room_id}/joined_members")
-                joined = resp["joined"]
+            for task in asyncio.as_completed([
+                _joined_members(room_id) for room_id in rooms_to_inspect
+            ]):
+                room_id, joined = await task
 
-                if _is_dm_in_space(joined):
+                if _is_dm_in_space(joined, members_set):
                     self.rooms_in_space[room_id] = f"DM with {_correspondant_display_name(joined)}"
 
                 pbar.update(1)
@@ -138,26 +205,55 @@ class Client:
         Args:
             new_display_name: The display name to set.
         """
-        current_profile = await self._req("GET", f"/_matrix/client/v3/profile/{self.user_id}")
+        current_profile = await self._req_with_retry("GET", f"/_matrix/client/v3/profile/{self.user_id}")
         evt_content = {
             "membership": "join",
             "displayname": new_display_name,
             "avatar_url": current_profile.get("avatar_url"),
         }
 
-        # Use a progress bar to indicate progress in updating each room.
+        # Limit the number of concurrent updates, so we don't trip the homeserver's rate
+        # limits by sending every PUT at once.
+        sem = asyncio.Semaphore(8)
+
+        # Use a progress bar to indicate progress in updating each room. Since every
+        # update happens on the same event loop, it's safe to share the bar between the
+        # update tasks.
         with tqdm(total=len(self.rooms_in_space), unit=" rooms") as tbar:
-            for room_id, room_name in self.rooms_in_space.items():
-                try:
-                    await self._req(
-                        "PUT",
-                        f"/_matrix/client/v3/rooms/{room_id}/state/m.room.member/{self.user_id}",
-                        json=evt_content,
-                    )
-                except HttpError as e:
-                    print(f"Failed to update \033[1m{room_name}\033[0m ({room_id}) (trying {e.url}): {e.code} - {e.content}")
-
-                tbar.update(1)
+            await asyncio.gather(*(
+                self._update_one(room_id, room_name, evt_content, sem, tbar)
+                for room_id, room_name in self.rooms_in_space.items()
+            ))
+
+    async def _update_one(
+        self,
+        room_id: str,
+        room_name: str,
+        evt_content: Dict[str, Any],
+        sem: asyncio.Semaphore,
+        tbar: tqdm,
+    ) -> None:
+        """Update our membership event in the given room, logging and swallowing any HTTP
+        error so the other updates can carry on.
+
+        Args:
+            room_id: The ID of the room to update.
+            room_name: The human-readable name of the room, for error messages.
+            evt_content: The content of the membership event to set.
+            sem: The semaphore bounding the number of concurrent updates.
+            tbar: The progress bar to update once done.
+        """
+        async with sem:
+            try:
+                await self._req_with_retry(
+                    "PUT",
+                    f"/_matrix/client/v3/rooms/{room_id}/state/m.room.member/{self.user_id}",
+                    json=evt_content,
+                )
+            except HttpError as e:
+                print(f"Failed to update \033[1m{room_name}\033[0m ({room_id}) (trying {e.url}): {e.code} - {e.content}")
+
+        tbar.update(1)
 
     async def _req(self, method: str, path: str, **kwargs: Any) -> Dict[str, Any]:
         """Send a request to the given path with the given method and arguments.
@@ -165,7 +261,7 @@ class Client:
         Args:
             method: The HTTP method to use.
             path: The path to affix to the base URL. Alternatively, this can be a full HTTPS URL.
-            **kwargs: The arguments to pass to aiohttp.ClientSession.request.
+            **kwargs: The arguments to pass to httpx.AsyncClient.request.
 
         Returns:
              The response parsed as JSON.
@@ -182,12 +278,62 @@ class Client:
 
             url = f"{self.base_url}{path}"
 
-        async with aiohttp.ClientSession(headers={"Authorization": f"Bearer {self.tok}"}) as session:
-            async with session.request(method, url, **kwargs) as resp:
-                if resp.status != 200:
-                    raise HttpError(code=resp.status, content=await resp.text(), url=url)
+        resp = await self._session.request(method, url, **kwargs)
+        if resp.status_code != 200:
+            raise HttpError(
+                code=resp.status_code,
+                content=resp.text,
+                url=url,
+                retry_after=resp.headers.get("Retry-After"),
+            )
+
+        return resp.json()
 
-                return await resp.json()
+    async def _req_with_retry(self, method: str, path: str, **kwargs: Any) -> Dict[str, Any]:
+        """Send a request through _req, retrying transient failures with exponential
+        backoff and jitter.
+
+        Transient failures are rate limits (429), common gateway/server errors (500, 502,
+        503, 504) and network-level errors. Anything else (including running out of
+        attempts) is raised to the caller as _req would. The jitter avoids all concurrent
+        requests retrying in lockstep after a shared hiccup.
+
+        Args:
+            method: The HTTP method to use.
+            path: The path to affix to the base URL. Alternatively, this can be a full HTTPS URL.
+            **kwargs: The arguments to pass to httpx.AsyncClient.request.
+
+        Returns:
+             The response parsed as JSON.
+        """
+        base = 0.5
+        cap = 30.0
+        max_attempts = 6
+
+        for attempt in range(max_attempts):
+            try:
+                return await self._req(method, path, **kwargs)
+            except HttpError as e:
+                if e.code not in {429, 500, 502, 503, 504} or attempt == max_attempts - 1:
+                    raise
+
+                delay = min(cap, base * 2 ** attempt) + random.uniform(0, base)
+                # If the server is rate-limiting us and tells us how long to wait, trust
+                # it over our own schedule.
+                if e.code == 429 and e.retry_after is not None and e.retry_after.isdigit():
+                    delay = float(e.retry_after)
+            except httpx.HTTPError:
+                if attempt == max_attempts - 1:
+                    raise
+
+                delay = min(cap, base * 2 ** attempt) + random.uniform(0, base)
+
+            await asyncio.sleep(delay)
+
+    async def close(self) -> None:
+        """Close the underlying HTTP session. Must be called once we're done with the client."""
+        if self._session is not None:
+            await self._session.aclose()
 
 
 if __name__ == '__main__':
@@ -218,14 +364,17 @@ if __name__ == '__main__':
 
     async def _main():
         client = Client(user_id=args.user_id, tok=args.access_token)
-        await client.init()
+        try:
+            await client.init()
 
-        await client.find_rooms_in_space(args.space)
-        print("\nYour display name will be changed in the following rooms:")
-        client.list_target_rooms()
+            await client.find_rooms_in_space(args.space)
+            print("\nYour display name will be changed in the following rooms:")
+            client.list_target_rooms()
 
-        choice = input("\nContinue? [Y/n] ")
-        if choice == "" or choice.lower() == "y":
-            await client.change_display_name(args.new_display_name)
+            choice = input("\nContinue? [Y/n] ")
+            if choice == "" or choice.lower() == "y":
+                await client.change_display_name(args.new_display_name)
+        finally:
+            await client.close()
 
     asyncio.run(_main())
@@ -1,24 +1,25 @@
 # Define and parse command line arguments.
 import argparse
+import errno
 import os
-import re
 import shutil
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import List, Dict
 
 from tqdm import tqdm
 
-# Regular expression to identify (and parse) the supported file names.
+# Prefixes identifying the supported file names, with an 8-digit date expected right
+# after the prefix. This used to be a regular expression, but the names we're looking for
+# are so rigid that a prefix check plus a slice does the same job for a fraction of the
+# cost per file (the old pattern also used a character class where it meant an
+# alternation, so it matched more prefixes than intended).
 # This might change depending on what type of file I'm moving, and what naming convention
 # my camera at the time used.
-# It's very likely easy to consolidate the first 2 into one expression, but heh, it's past
-# midnight right now.
 # Videos go to a different directory, so let's make sure not to match them at the same
 # time as photos (the backup I'm dealing with is messy like that).
-FILE_NAME_REGEX = "^[IMG|PANO]+_([0-9]{8})_([0-9]{6})"
-# FILE_NAME_REGEX = "([0-9]{8})_([0-9]{6})"
-# FILE_NAME_REGEX = "^VID+_([0-9]{8})_([0-9]{6})"
+FILE_NAME_PREFIXES = ("IMG_", "PANO_")
+# FILE_NAME_PREFIXES = ("VID_",)
 
 # Define and parse the arguments.
 parser = argparse.ArgumentParser(
@@ -32,50 +33,104 @@ parser.add_argument(
 
 args = parser.parse_args()
 
-# Read the files (and count them for later).
-files = os.listdir(args.path)
-n_files = len(files)
+# Read the files (and count them for later). os.scandir hands back DirEntry objects
+# carrying the metadata the kernel already returned with each entry, so we can keep only
+# actual files (e.g. skip the yyyy/mm directories from a previous run) and reuse the
+# entry's ready-made absolute path later, without paying an extra stat per entry.
+entries = [entry for entry in os.scandir(args.path) if entry.is_file()]
+n_files = len(entries)
 
 # Track the files that need moving. This dict associates the absolute path of a directory
-# to the names of files that must be moved to this directory.
-files_to_move: Dict[str, List[str]] = {}
-# Iterate over the file names.
-for file in files:
-    # Check if the file name matches the regular expression.
-    match = re.match(FILE_NAME_REGEX, file)
-    if match is not None:
-        # If so, extract the date and parse it.
-        date = datetime.strptime(match.group(1), "%Y%m%d")
+# to the directory entries of files that must be moved to this directory.
+files_to_move: Dict[str, List[os.DirEntry]] = {}
+# Cache the destination list for each date: most photos in a batch come from a handful
+# of days, so after the first file of a given day, every other file from that day is
+# grouped with a prefix check, a slice and a single dict lookup - no date parsing, no
+# path building, and no second lookup into files_to_move.
+files_for_date: Dict[str, List[os.DirEntry]] = {}
+# Iterate over the directory entries.
+for entry in entries:
+    file = entry.name
 
-        # Figure out the absolute path of the directory that this file must go into.
-        # This directory is yyyy/mm (under the directory given by args.path), based on the
-        # date indicated in the file's name.
-        dir_path = date.strftime("%Y/%m")
-        dir_path = os.path.join(args.path, dir_path)
-
-        # Record the file in the dictionary.
-        if dir_path not in files_to_move:
-            files_to_move[dir_path] = []
-        files_to_move[dir_path].append(file)
-    else:
+    # Check if the file name starts with one of the supported prefixes, and if so slice
+    # the date out of it.
+    date_str = None
+    for prefix in FILE_NAME_PREFIXES:
+        if file.startswith(prefix):
+            date_str = file[len(prefix):len(prefix) + 8]
+            break
+
+    if date_str is None:
         # If the file name does not match, ajust the number of files to move.
         n_files -= 1
+        continue
+
+    dir_files = files_for_date.get(date_str)
+    if dir_files is None:
+        # First time we see this date: validate it.
+        if not date_str.isdigit():
+            n_files -= 1
+            continue
+
+        # Figure out the absolute path of the directory that this file must go into.
+        # This directory is yyyy/mm (under the directory given by args.path), based on
+        # the date indicated in the file's name. The date string is already in yyyymmdd
+        # form, so the directory can be sliced straight out of it - no need for the
+        # strptime/strftime round-trip this used to do. Build it with an f-string rather
+        # than os.path.join, which has surprising overhead in a loop this tight.
+        dir_path = f"{args.path}/{date_str[:4]}/{date_str[4:6]}"
+
+        # Several dates map to the same yyyy/mm directory, so the cache points straight
+        # at that directory's list in files_to_move.
+        dir_files = files_to_move.setdefault(dir_path, [])
+        files_for_date[date_str] = dir_files
+
+    # Record the file in the dictionary.
+    dir_files.append(entry)
 
 print(f"Moving {n_files} files")
 
+# Create every target directory upfront, so the move loop below is nothing but renames.
+for dir_path in files_to_move:
+    Path(dir_path).mkdir(parents=True, exist_ok=True)
+
+# Precompute the source and destination paths of every file to move. The source path
+# comes straight from the directory entry.
+moves = [
+    (entry.path, f"{dir_path}/{entry.name}")
+    for dir_path, dir_entries in files_to_move.items()
+    for entry in dir_entries
+]
+
+def move_file(src_path: str, dst_path: str) -> None:
+    """Move a single file. Within the same filesystem a rename is a single syscall, much
+    cheaper than the extra stat'ing shutil.move does on every call - which adds up when
+    moving tens of thousands of photos. Only fall back to shutil.move (which copies) if
+    the destination turns out to be on a different filesystem.
+    """
+    try:
+        os.replace(src_path, dst_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src_path, dst_path)
+
+
 # Show a nice progress bar.
 with tqdm(total=n_files) as pbar:
-    for dir_path, files in files_to_move.items():
-        # Create each directory if necessary.
-        Path(dir_path).mkdir(parents=True, exist_ok=True)
-
-        for file in files:
-            # Figure out the file's absolute source and destination paths.
-            src_path = os.path.join(args.path, file)
-            dst_path = os.path.join(dir_path, file)
+    # Spread the moves over a thread pool: rename syscalls release the GIL, so the
+    # per-file latency actually overlaps - which makes a huge difference on spinning
+    # disks or network filesystems. The target directories were all created above, so
+    # the threads can't race on mkdir.
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4) * 4)) as executor:
+        futures = [
+            executor.submit(move_file, src_path, dst_path)
+            for src_path, dst_path in moves
+        ]
 
-            # Move the file.
-            shutil.move(src_path, dst_path)
+        for future in as_completed(futures):
+            # Surface any error the move may have raised.
+            future.result()
 
             # Update the progress bar.
             pbar.update(1)